@@ -0,0 +1,323 @@
+# analytics.py
+
+import os
+import shutil
+import tempfile
+import time
+import argparse
+from datetime import datetime
+
+import duckdb
+from dotenv import load_dotenv
+
+import replica
+import schema
+
+# Load environment variables
+load_dotenv()
+
+SNAPSHOT_DIR = os.getenv("ANALYTICS_SNAPSHOT_DIR", "data/snapshots")
+EXPORT_INTERVAL_SECONDS = int(os.getenv("ANALYTICS_EXPORT_SECONDS", "900"))
+# Superseded snapshots are kept this long so renders already reading them finish.
+SNAPSHOT_GRACE_SECONDS = int(os.getenv("ANALYTICS_SNAPSHOT_GRACE_SECONDS", "600"))
+
+# Each export goes to SNAPSHOT_DIR/<version>/{queries,support_activities} and
+# is published by replacing the CURRENT pointer file.
+CURRENT_FILE = "CURRENT"
+VERSION_FORMAT = "%Y%m%dT%H%M%S%f"
+
+_schema_ready = False
+
+class SnapshotUnavailable(Exception):
+    """
+    No readable snapshot; callers fall back to querying PostgreSQL.
+    """
+
+# Columns are exported as local timestamps in the database session's time zone,
+# matching what DATE(login_time) and friends return inside PostgreSQL.
+QUERIES_EXPORT = """
+    SELECT id, status, priority, sla_hours, assigned_to,
+           date_raised::timestamp AS date_raised,
+           date_closed::timestamp AS date_closed
+    FROM queries
+"""
+QUERIES_COLUMNS = {
+    "id": "INTEGER",
+    "status": "VARCHAR",
+    "priority": "VARCHAR",
+    "sla_hours": "INTEGER",
+    "assigned_to": "VARCHAR",
+    "date_raised": "TIMESTAMP",
+    "date_closed": "TIMESTAMP",
+}
+
+ACTIVITIES_EXPORT = """
+    SELECT id, username,
+           login_time::timestamp AS login_time,
+           logout_time::timestamp AS logout_time,
+           last_heartbeat::timestamp AS last_heartbeat
+    FROM support_activities
+"""
+ACTIVITIES_COLUMNS = {
+    "id": "INTEGER",
+    "username": "VARCHAR",
+    "login_time": "TIMESTAMP",
+    "logout_time": "TIMESTAMP",
+    "last_heartbeat": "TIMESTAMP",
+}
+
+# ========================================
+# EXPORT
+# ========================================
+def get_export_connection():
+    """
+    Read from the replica when it is configured, reachable and not lagging,
+    otherwise from the primary.
+    """
+    return replica.connect_for_reads()
+
+def export_table(cur, select_sql, columns, partition_expr, target):
+    """
+    Stream one table out of PostgreSQL with COPY and write it to target as
+    Parquet partitioned by month.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w+", suffix=".csv", dir=os.path.dirname(target), delete=False) as f:
+        csv_path = f.name
+        cur.copy_expert(f"COPY ({select_sql}) TO STDOUT WITH CSV HEADER", f)
+    con = duckdb.connect()
+    try:
+        con.execute(
+            f"""
+            COPY (
+                SELECT *, strftime({partition_expr}, '%Y-%m') AS month
+                FROM read_csv(?, header = true, columns = {columns!r})
+            ) TO '{target}' (FORMAT PARQUET, PARTITION_BY (month))
+            """,
+            [csv_path],
+        )
+        # An empty table produces no partitions; write one empty file so the
+        # snapshot can still be read with the right schema.
+        if not any(files for _, _, files in os.walk(target)):
+            empty = os.path.join(target, "month=0000-00")
+            os.makedirs(empty, exist_ok=True)
+            con.execute(
+                f"""
+                COPY (
+                    SELECT * FROM read_csv(?, header = true, columns = {columns!r}) LIMIT 0
+                ) TO '{os.path.join(empty, "data_0.parquet")}' (FORMAT PARQUET)
+                """,
+                [csv_path],
+            )
+    finally:
+        con.close()
+        os.remove(csv_path)
+
+def publish_snapshot(version, snapshot_dir=SNAPSHOT_DIR):
+    # os.replace is atomic, so readers see either the old version or the new
+    # one, never a mix of tables from both.
+    pointer = os.path.join(snapshot_dir, CURRENT_FILE)
+    with open(pointer + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+
+def remove_old_snapshots(snapshot_dir=SNAPSHOT_DIR, grace_seconds=SNAPSHOT_GRACE_SECONDS):
+    """
+    Delete versions older than the current one once the version that
+    replaced them has been live for grace_seconds. Leftovers from failed
+    exports are older than the current version and go the same way.
+    """
+    current = current_version(snapshot_dir)
+    if current is None:
+        return
+    versions = sorted(
+        name for name in os.listdir(snapshot_dir)
+        if os.path.isdir(os.path.join(snapshot_dir, name)) and name < current
+    ) + [current]
+    now = datetime.now()
+    for old, successor in zip(versions, versions[1:]):
+        replaced_at = datetime.strptime(successor, VERSION_FORMAT)
+        if (now - replaced_at).total_seconds() >= grace_seconds:
+            shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+
+def export_snapshots(snapshot_dir=SNAPSHOT_DIR):
+    global _schema_ready
+    if not _schema_ready:
+        # The exporter may run before the app has ever touched the database.
+        schema.ensure_session_schema()
+        _schema_ready = True
+    version = datetime.now().strftime(VERSION_FORMAT)
+    version_dir = os.path.join(snapshot_dir, version)
+    conn = get_export_connection()
+    cur = conn.cursor()
+    try:
+        export_table(cur, QUERIES_EXPORT, QUERIES_COLUMNS, "date_raised",
+                     os.path.join(version_dir, "queries"))
+        export_table(cur, ACTIVITIES_EXPORT, ACTIVITIES_COLUMNS, "login_time",
+                     os.path.join(version_dir, "support_activities"))
+    finally:
+        cur.close()
+        conn.close()
+    publish_snapshot(version, snapshot_dir)
+    remove_old_snapshots(snapshot_dir)
+
+# ========================================
+# QUERIES OVER SNAPSHOTS
+# ========================================
+def current_version(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return version or None
+
+def snapshot_time(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Return when the published snapshot was exported, or None if there is none.
+    """
+    version = current_version(snapshot_dir)
+    if version is None:
+        return None
+    try:
+        return datetime.strptime(version, VERSION_FORMAT)
+    except ValueError:
+        return None
+
+def _query(sql, params, snapshot_dir):
+    # Resolve the pointer once so both views come from the same version.
+    version = current_version(snapshot_dir)
+    if version is None:
+        raise SnapshotUnavailable("no published snapshot")
+    con = duckdb.connect()
+    try:
+        for name in ("queries", "support_activities"):
+            path = os.path.join(snapshot_dir, version, name, "**", "*.parquet")
+            con.execute(
+                f"""
+                CREATE VIEW {name} AS
+                SELECT * FROM read_parquet('{path}', hive_partitioning = true)
+                """
+            )
+        return con.execute(sql, params).df()
+    except duckdb.IOException as e:
+        raise SnapshotUnavailable(str(e)) from e
+    finally:
+        con.close()
+
+def _ticket_filters(status=None, since=None, ticket_id=None):
+    # The month predicate lets DuckDB skip whole partitions.
+    clauses, params = [], []
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if since:
+        clauses.append("month >= ? AND date_raised >= ?")
+        params += [since.strftime("%Y-%m"), since]
+    if ticket_id:
+        clauses.append("id = ?")
+        params.append(ticket_id)
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    return where, params
+
+def monthly_ticket_volume(status=None, since=None, ticket_id=None, snapshot_dir=SNAPSHOT_DIR):
+    where, params = _ticket_filters(status, since, ticket_id)
+    return _query(
+        f"""
+        SELECT date_trunc('month', date_raised) AS month, COUNT(*) AS count
+        FROM queries
+        {where}
+        GROUP BY date_trunc('month', date_raised)
+        ORDER BY 1
+        """,
+        params,
+        snapshot_dir,
+    )
+
+def status_distribution(status=None, since=None, ticket_id=None, snapshot_dir=SNAPSHOT_DIR):
+    where, params = _ticket_filters(status, since, ticket_id)
+    return _query(
+        f"""
+        SELECT status, COUNT(*) AS count
+        FROM queries
+        {where}
+        GROUP BY status
+        ORDER BY count DESC
+        """,
+        params,
+        snapshot_dir,
+    )
+
+def daily_login_totals(since, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Same shape as app.get_daily_login_totals(): username, day, seconds.
+    """
+    return _query(
+        """
+        SELECT username,
+        CAST(login_time AS DATE) AS day,
+        SUM(EXTRACT(EPOCH FROM (
+            COALESCE(logout_time, last_heartbeat, login_time) - login_time
+        ))) AS seconds
+        FROM support_activities
+        WHERE month >= ? AND login_time >= ?
+        GROUP BY username, day
+        ORDER BY day DESC
+        """,
+        [since.strftime("%Y-%m"), since],
+        snapshot_dir,
+    )
+
+def time_to_close(by="priority", since=None, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Median and p90 hours from date_raised to date_closed for closed tickets,
+    grouped by "priority" or by "agent" (each name in assigned_to).
+    """
+    if by == "priority":
+        group = "priority"
+    elif by == "agent":
+        group = "TRIM(UNNEST(string_split(assigned_to, ',')))"
+    else:
+        raise ValueError(f"Unknown grouping: {by}")
+
+    where, params = _ticket_filters("Closed", since)
+    return _query(
+        f"""
+        WITH closed AS (
+            SELECT {group} AS {by},
+            EXTRACT(EPOCH FROM (date_closed - date_raised)) / 3600 AS hours
+            FROM queries
+            {where}
+            AND date_closed IS NOT NULL
+        )
+        SELECT {by},
+        COUNT(*) AS tickets,
+        quantile_cont(hours, 0.5) AS median_hours,
+        quantile_cont(hours, 0.9) AS p90_hours
+        FROM closed
+        WHERE {by} IS NOT NULL AND {by} <> ''
+        GROUP BY {by}
+        ORDER BY median_hours
+        """,
+        params,
+        snapshot_dir,
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Parquet snapshots for the Admin analytics.")
+    parser.add_argument("--once", action="store_true", help="export once and exit")
+    args = parser.parse_args()
+
+    while True:
+        started = time.monotonic()
+        try:
+            export_snapshots()
+            print(f"Snapshots exported to {SNAPSHOT_DIR} in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            # Keep the previous snapshot published and try again next round.
+            print(f"Snapshot export failed at {datetime.now():%Y-%m-%d %H:%M:%S}:", e)
+            if args.once:
+                raise
+        if args.once:
+            break
+        time.sleep(EXPORT_INTERVAL_SECONDS)
@@ -4,39 +4,148 @@ import psycopg2
 import pandas as pd
 import hashlib
 import time
+import threading
 import matplotlib.pyplot as plt
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine
-from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
+import analytics
+import replica
+import schema
+
 # ========================================
 # LOAD ENV
 # ========================================
 load_dotenv()
 
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT = os.getenv("DB_PORT")
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
+# Live sessions ping every SESSION_HEARTBEAT_SECONDS; pings are buffered and
+# written every SESSION_FLUSH_SECONDS; sessions silent for longer than
+# SESSION_STALE_SECONDS are closed at their last heartbeat.
+SESSION_HEARTBEAT_SECONDS = int(os.getenv("SESSION_HEARTBEAT_SECONDS", "60"))
+SESSION_FLUSH_SECONDS = int(os.getenv("SESSION_FLUSH_SECONDS", "30"))
+SESSION_STALE_SECONDS = int(os.getenv("SESSION_STALE_SECONDS", "300"))
 
 # ========================================
 # DB CONNECTION
 # ========================================
 def get_connection():
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-    )
+    return replica.connect_primary()
 
 def get_engine():
+    return create_engine(replica.engine_url(replica.PRIMARY))
+
+# ========================================
+# READ / WRITE ROUTING
+# ========================================
+@st.cache_resource
+def get_replica_engine():
     return create_engine(
-        f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+        replica.engine_url(replica.REPLICA),
+        pool_pre_ping=True,
+        connect_args={"connect_timeout": replica.REPLICA_CONNECT_TIMEOUT},
     )
-    
+
+@st.cache_resource
+def get_replica_state():
+    # Shared by every browser session served by this process.
+    return {
+        "lock": threading.Lock(),
+        "lag": None,
+        "healthy": False,
+        "checked_at": None,
+        "refreshing": False,
+    }
+
+def measure_replica_lag():
+    conn = get_replica_engine().raw_connection()
+    try:
+        return replica.replica_lag(conn)
+    finally:
+        conn.close()
+
+def replica_status():
+    # One caller refreshes the measurement outside the lock; everyone else
+    # reads the cached result instead of waiting on the network.
+    state = get_replica_state()
+    with state["lock"]:
+        checked_at = state["checked_at"]
+        fresh = checked_at is not None and time.monotonic() - checked_at < replica.REPLICA_CHECK_SECONDS
+        if fresh or state["refreshing"]:
+            return state["healthy"], state["lag"]
+        state["refreshing"] = True
+
+    try:
+        lag = measure_replica_lag()
+    except Exception:
+        lag = None
+
+    with state["lock"]:
+        state["lag"] = lag
+        state["healthy"] = lag is not None and lag <= replica.REPLICA_MAX_LAG_BYTES
+        state["checked_at"] = time.monotonic()
+        state["refreshing"] = False
+        return state["healthy"], state["lag"]
+
+def mark_primary_reads(cur):
+    # Read-your-own-writes: remember where the primary's WAL was when this
+    # browser session last wrote; call after commit.
+    if replica.REPLICA_ENABLED:
+        st.session_state.write_lsn = replica.current_lsn(cur)
+
+def replica_has_replayed(lsn):
+    try:
+        conn = get_replica_engine().raw_connection()
+    except Exception:
+        return False
+    try:
+        return replica.replica_has_replayed(conn, lsn)
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+def get_read_engine():
+    if not replica.REPLICA_ENABLED:
+        return get_engine()
+    healthy, _ = replica_status()
+    if not healthy:
+        return get_engine()
+    # Stay on the primary until the replica has replayed this session's
+    # last write. Replay only moves forward, so one confirmation is enough.
+    write_lsn = st.session_state.get("write_lsn")
+    if write_lsn is not None:
+        replayed = replica_has_replayed(write_lsn)
+        if replayed is None:
+            # No replay position: the server is no longer a standby.
+            mark_replica_unhealthy()
+        if not replayed:
+            return get_engine()
+        st.session_state.write_lsn = None
+    return get_replica_engine()
+
+def mark_replica_unhealthy():
+    # Forces the next replica_status() call to measure again.
+    state = get_replica_state()
+    with state["lock"]:
+        state["healthy"] = False
+        state["lag"] = None
+        state["checked_at"] = None
+
+def read_sql(query, params=None):
+    # Dashboard reads: try the replica when routing allows it, and retry on
+    # the primary if the replica fails between health checks.
+    engine = get_read_engine()
+    try:
+        return pd.read_sql(query, engine, params=params)
+    except OperationalError:
+        if not replica.REPLICA_ENABLED or engine is not get_replica_engine():
+            raise
+        mark_replica_unhealthy()
+        return pd.read_sql(query, get_engine(), params=params)
+
 # ========================================
 # LOGIN ANALYTICS HELPERS
 # ========================================
@@ -45,16 +154,32 @@ def format_time(seconds):
     mins = int((seconds % 3600) // 60)
     return f"{hrs}h {mins}m"
 
-def get_daily_login_totals():
+def get_daily_login_totals(since):
+    # Open sessions count up to their last heartbeat, never to NOW(), so an
+    # abandoned tab cannot inflate the totals before the reaper closes it.
+    flush_heartbeats()
     query = """
         SELECT username,
         DATE(login_time) AS day,
-        SUM(EXTRACT(EPOCH FROM (COALESCE(logout_time, NOW()) - login_time))) AS seconds
+        SUM(EXTRACT(EPOCH FROM (
+            COALESCE(logout_time, last_heartbeat, login_time) - login_time
+        ))) AS seconds
         FROM support_activities
+        WHERE login_time >= %s
         GROUP BY username, day
         ORDER BY day DESC
     """
-    return pd.read_sql(query, get_engine())
+    # Read from the primary: the flush above has just written there.
+    return pd.read_sql(query, get_engine(), params=(since,))
+
+def load_login_totals(since):
+    # Prefer the Parquet snapshots so the dashboard stays off PostgreSQL.
+    if analytics.snapshot_time() is not None:
+        try:
+            return analytics.daily_login_totals(since)
+        except analytics.SnapshotUnavailable:
+            pass
+    return get_daily_login_totals(since)
 
 # ========================================
 # PASSWORD HASH
@@ -90,26 +215,143 @@ def login_user(username, password, role):
         (username.upper(), make_hash(password), role),
     )
     user = cur.fetchone()
-    if user:
+    cur.close()
+    conn.close()
+    return user
+
+def logout_user(username, session_id=None):
+    if session_id is not None:
+        discard_heartbeat(session_id)
+    conn = get_connection()
+    cur = conn.cursor()
+    if session_id is not None:
         cur.execute(
-            "INSERT INTO support_activities (username, login_time) VALUES (%s,%s)",
-            (username.upper(), datetime.now()),
+            "UPDATE support_activities SET logout_time=%s WHERE id=%s AND logout_time IS NULL",
+            (datetime.now(timezone.utc), session_id),
         )
-        conn.commit()
+    else:
+        cur.execute(
+            "UPDATE support_activities SET logout_time=%s WHERE username=%s AND logout_time IS NULL",
+            (datetime.now(timezone.utc), username.upper()),
+        )
+    conn.commit()
     cur.close()
     conn.close()
-    return user
 
-def logout_user(username):
+# ========================================
+# SESSION TRACKING
+# ========================================
+@st.cache_resource
+def ensure_session_schema():
+    schema.ensure_session_schema()
+    return True
+
+@st.cache_resource
+def get_heartbeat_buffer():
+    # Shared by every browser session served by this process.
+    return {
+        "lock": threading.Lock(),
+        "pending": {},
+        # Sessions the reaper closed while their tab was away, mapped to the
+        # heartbeat that showed the tab is back.
+        "expired": {},
+        "last_flush": time.monotonic(),
+    }
+
+def start_session(username, started=None):
+    now = started or datetime.now(timezone.utc)
     conn = get_connection()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE support_activities SET logout_time=%s WHERE username=%s AND logout_time IS NULL",
-        (datetime.now(), username.upper()),
+        """
+        INSERT INTO support_activities (username, login_time, last_heartbeat)
+        VALUES (%s,%s,%s)
+        RETURNING id
+        """,
+        (username.upper(), now, now),
     )
+    session_id = cur.fetchone()[0]
     conn.commit()
     cur.close()
     conn.close()
+    return session_id
+
+def record_heartbeat(session_id):
+    buf = get_heartbeat_buffer()
+    with buf["lock"]:
+        # Timezone-aware, so PostgreSQL stores the same instant whatever the
+        # app host's and the database's time zones are; the reaper compares
+        # these against the server's NOW().
+        buf["pending"][session_id] = datetime.now(timezone.utc)
+        due = time.monotonic() - buf["last_flush"] >= SESSION_FLUSH_SECONDS
+    if due:
+        flush_heartbeats()
+
+def discard_heartbeat(session_id):
+    buf = get_heartbeat_buffer()
+    with buf["lock"]:
+        buf["pending"].pop(session_id, None)
+        buf["expired"].pop(session_id, None)
+
+def take_expired(session_id):
+    buf = get_heartbeat_buffer()
+    with buf["lock"]:
+        return buf["expired"].pop(session_id, None)
+
+def flush_heartbeats():
+    buf = get_heartbeat_buffer()
+    with buf["lock"]:
+        pending = buf["pending"]
+        buf["pending"] = {}
+        buf["last_flush"] = time.monotonic()
+        # A live tab claims its entry on its next heartbeat; anything older
+        # belongs to a tab that logged out or went away again.
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_STALE_SECONDS)
+        buf["expired"] = {
+            sid: beat for sid, beat in buf["expired"].items() if beat >= cutoff
+        }
+
+    conn = get_connection()
+    cur = conn.cursor()
+    if pending:
+        updated = execute_values(
+            cur,
+            """
+            UPDATE support_activities AS sa
+            SET last_heartbeat = GREATEST(sa.last_heartbeat, v.beat)
+            FROM (VALUES %s) AS v (id, beat)
+            WHERE sa.id = v.id
+            AND sa.logout_time IS NULL
+            RETURNING sa.id
+            """,
+            list(pending.items()),
+            template="(%s::int, %s::timestamptz)",
+            fetch=True,
+        )
+        # Anything not updated was already closed by the reaper: the tab came
+        # back after SESSION_STALE_SECONDS and needs a fresh session.
+        closed = set(pending) - {row[0] for row in updated}
+        if closed:
+            with buf["lock"]:
+                for session_id in closed:
+                    buf["expired"][session_id] = pending[session_id]
+    reap_stale_sessions(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def reap_stale_sessions(cur):
+    # Served by the partial index on open sessions, so cost tracks the number
+    # of live sessions rather than the size of the history.
+    cur.execute(
+        """
+        UPDATE support_activities
+        SET logout_time = last_heartbeat
+        WHERE logout_time IS NULL
+        AND last_heartbeat < NOW() - make_interval(secs => %s)
+        """,
+        (SESSION_STALE_SECONDS,),
+    )
 
 # ========================================
 # QUERY FUNCTIONS
@@ -136,23 +378,22 @@ def insert_query(email, mobile, heading, desc):
         (email, mobile, heading, desc),
     )
     conn.commit()
+    mark_primary_reads(cur)
     cur.close()
     conn.close()
 
 def get_all_queries():
-    return pd.read_sql(
-        "SELECT * FROM queries ORDER BY date_raised DESC",
-        get_engine()
-    )
+    return read_sql("SELECT * FROM queries ORDER BY date_raised DESC")
 
 def update_query_status(qid, status):
     conn = get_connection()
     cur = conn.cursor()
     cur.execute(
         "UPDATE queries SET status=%s, date_closed=%s WHERE id=%s",
-        (status, datetime.now() if status == "Closed" else None, qid),
+        (status, datetime.now(timezone.utc) if status == "Closed" else None, qid),
     )
     conn.commit()
+    mark_primary_reads(cur)
     cur.close()
     conn.close()
 
@@ -175,11 +416,12 @@ def bulk_assign_tickets(ticket_ids, supports, priority, sla):
             (priority, sla, assigned, tid),
         )
     conn.commit()
+    mark_primary_reads(cur)
     cur.close()
     conn.close()
 
 def get_assigned_open(username):
-    return pd.read_sql(
+    return read_sql(
         """
         SELECT *
         FROM queries
@@ -187,7 +429,6 @@ def get_assigned_open(username):
         AND UPPER(assigned_to) LIKE %s
         ORDER BY date_raised DESC
         """,
-        get_engine(),
         params=(f"%{username.upper()}%",),
     )
 
@@ -196,6 +437,7 @@ def add_comment(qid, note, username=None):
     cur = conn.cursor()
     cur.execute("UPDATE queries SET comments=%s WHERE id=%s", (note, qid))
     conn.commit()
+    mark_primary_reads(cur)
     cur.close()
     conn.close()
 
@@ -284,6 +526,8 @@ if "role" not in st.session_state:
     st.session_state.role = None
 if "username" not in st.session_state:
     st.session_state.username = None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = None
     
 # ------------------ STYLES ------------------
 def global_styles():
@@ -328,6 +572,7 @@ def login_page():
             user = login_user(u, p, r)
             if user:
                 st.session_state.logged_in = True
+                st.session_state.session_id = start_session(u)
                 st.session_state.username = u.upper()
                 st.session_state.role = r
                 st.session_state.page = "home"
@@ -405,11 +650,24 @@ def register_page():
     st.markdown('</div>', unsafe_allow_html=True)
 
 
+# ------------------ HEARTBEAT ------------------
+@st.fragment(run_every=SESSION_HEARTBEAT_SECONDS)
+def session_heartbeat():
+    if st.session_state.session_id is None:
+        return
+    returned_at = take_expired(st.session_state.session_id)
+    if returned_at is not None:
+        st.session_state.session_id = start_session(st.session_state.username, returned_at)
+    record_heartbeat(st.session_state.session_id)
+
+
 # ------------------ HOME (ROLE BASED) ------------------
 def home_page():
+    session_heartbeat()
     st.sidebar.write(f"👤 {st.session_state.username} ({st.session_state.role})")
     if st.sidebar.button("Logout"):
-        logout_user(st.session_state.username)
+        logout_user(st.session_state.username, st.session_state.session_id)
+        st.session_state.session_id = None
         st.session_state.logged_in = False
         st.session_state.page = "login"
         st.rerun()
@@ -518,6 +776,13 @@ def home_page():
     if st.session_state.role == "Admin":
         st.header("🧑‍💼 Admin Dashboard")
 
+        if replica.REPLICA_ENABLED:
+            healthy, lag = replica_status()
+            if healthy:
+                st.caption(f"Dashboard reads served by replica (lag {lag / 1024:.0f} kB of WAL)")
+            else:
+                st.caption("Replica unavailable or lagging, dashboard reads served by primary")
+
         if "admin_assign_success" not in st.session_state:
             st.session_state.admin_assign_success = False
 
@@ -562,9 +827,8 @@ def home_page():
         st.subheader("📦 Assign Tickets")
 
         ticket_ids = st.multiselect("Select Tickets", dfv["id"])
-        supports = pd.read_sql(
-            "SELECT username FROM users WHERE role='Support'",
-            get_engine()
+        supports = read_sql(
+            "SELECT username FROM users WHERE role='Support'"
         )["username"]
 
         assign_to = st.multiselect("Assign To", supports)
@@ -585,9 +849,22 @@ def home_page():
         st.markdown("## 📊 Admin Analytics")
         st.caption("Ticket trends and resolution distribution")
 
-        df_f = dfv.copy()
+        snapshot_at = analytics.snapshot_time()
+        status_arg = None if status == "All" else status
+
+        if snapshot_at is not None:
+            try:
+                monthly_counts = analytics.monthly_ticket_volume(status_arg, date_val, tid)
+                status_counts = (
+                    analytics.status_distribution(status_arg, date_val, tid)
+                    .set_index("status")["count"]
+                )
+                st.caption(f"From analytics snapshot taken {snapshot_at:%d/%m/%y %H:%M}")
+            except analytics.SnapshotUnavailable:
+                snapshot_at = None
 
-        if not df_f.empty:
+        if snapshot_at is None:
+            df_f = dfv.copy()
             df_f["month"] = (
             df_f["date_raised"]
             .dt.tz_localize(None)
@@ -604,6 +881,7 @@ def home_page():
 
             status_counts = df_f["status"].value_counts()
 
+        if not monthly_counts.empty:
             c1, c2 = st.columns(2)
 
             with c1:
@@ -630,15 +908,37 @@ def home_page():
         else:
             st.info("No data available for analytics.")
 
+        # ---------- TIME TO CLOSE ----------
+        st.markdown("### ⏱ Time to Close (hours)")
+
+        if snapshot_at is not None:
+            try:
+                by_priority = analytics.time_to_close("priority", date_val)
+                by_agent = analytics.time_to_close("agent", date_val)
+            except analytics.SnapshotUnavailable:
+                snapshot_at = None
+
+        if snapshot_at is not None:
+            c1, c2 = st.columns(2)
+            with c1:
+                st.markdown("**By Priority**")
+                st.dataframe(by_priority.round(1), use_container_width=True)
+            with c2:
+                st.markdown("**By Agent**")
+                st.dataframe(by_agent.round(1), use_container_width=True)
+        else:
+            st.info("Run `python analytics.py` to export analytics snapshots.")
+
         st.markdown("---")
 
         # ---------- DAILY LOGIN TOTALS ----------
         st.subheader("📅 Daily Login Details")
 
-        daily = get_daily_login_totals()
+        today = pd.Timestamp.today().date()
+
+        daily = load_login_totals(today)
         daily["day"] = pd.to_datetime(daily["day"]).dt.date
 
-        today = pd.Timestamp.today().date()
         daily = daily[daily["day"] == today]
 
         daily["Total Time"] = daily["seconds"].apply(format_time)
@@ -651,13 +951,13 @@ def home_page():
         # ---------- WEEKLY LOGIN TOTALS ----------
         st.subheader("📅 Weekly Login Details")
 
-        weekly = get_daily_login_totals()
-        weekly["day"] = pd.to_datetime(weekly["day"])
-
-        today = pd.Timestamp.today()
+        today = pd.Timestamp.today().normalize()
         start_date = today - pd.Timedelta(days=today.weekday())
         end_date = start_date + pd.Timedelta(days=4)
 
+        weekly = load_login_totals(start_date.date())
+        weekly["day"] = pd.to_datetime(weekly["day"])
+
         weekly = weekly[
             (weekly["day"] >= start_date) &
             (weekly["day"] <= end_date)
@@ -679,6 +979,7 @@ def home_page():
         )
 
 def run_app():
+    ensure_session_schema()
     if st.session_state.page == "login":
         login_page()
     elif st.session_state.page == "forgot":
@@ -0,0 +1,108 @@
+# replica.py
+
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Optional read replica for dashboard and analytics reads. Leave REPLICA_DB_HOST
+# unset to send everything to the primary; the other REPLICA_DB_* values
+# default to the primary's.
+PRIMARY = {
+    "host": os.getenv("DB_HOST"),
+    "port": os.getenv("DB_PORT"),
+    "dbname": os.getenv("DB_NAME"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+}
+REPLICA = {
+    "host": os.getenv("REPLICA_DB_HOST"),
+    "port": os.getenv("REPLICA_DB_PORT", PRIMARY["port"]),
+    "dbname": os.getenv("REPLICA_DB_NAME", PRIMARY["dbname"]),
+    "user": os.getenv("REPLICA_DB_USER", PRIMARY["user"]),
+    "password": os.getenv("REPLICA_DB_PASSWORD", PRIMARY["password"]),
+}
+REPLICA_ENABLED = bool(REPLICA["host"])
+
+# Lag is the WAL the replica has still to replay, in bytes.
+REPLICA_MAX_LAG_BYTES = int(os.getenv("REPLICA_MAX_LAG_BYTES", str(16 * 1024 * 1024)))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "10"))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "3"))
+
+def engine_url(dsn):
+    return (
+        f"postgresql+psycopg2://{dsn['user']}:{dsn['password']}"
+        f"@{dsn['host']}:{dsn['port']}/{dsn['dbname']}"
+    )
+
+def connect_primary():
+    return psycopg2.connect(**PRIMARY)
+
+def connect_replica():
+    return psycopg2.connect(**REPLICA, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+
+def current_lsn(cur):
+    """
+    WAL position on the primary, e.g. right after a write commits.
+    """
+    cur.execute("SELECT pg_current_wal_lsn()::text")
+    return cur.fetchone()[0]
+
+def replica_lag(replica_conn):
+    """
+    Return how many bytes of WAL the replica is behind the primary, or None
+    if the server is not a standby (misconfigured host, promoted replica).
+    """
+    conn = connect_primary()
+    try:
+        cur = conn.cursor()
+        lsn = current_lsn(cur)
+        cur.close()
+    finally:
+        conn.close()
+
+    cur = replica_conn.cursor()
+    cur.execute(
+        """
+        SELECT pg_is_in_recovery(),
+               pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn())
+        """,
+        (lsn,),
+    )
+    in_recovery, lag = cur.fetchone()
+    cur.close()
+    if not in_recovery or lag is None:
+        return None
+    return max(int(lag), 0)
+
+def replica_has_replayed(replica_conn, lsn):
+    """
+    True once the replica has replayed up to lsn; None if it is not a standby.
+    """
+    cur = replica_conn.cursor()
+    cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (lsn,))
+    replayed = cur.fetchone()[0]
+    cur.close()
+    return replayed
+
+def connect_for_reads():
+    """
+    Connect to the replica if it is configured, reachable and within
+    REPLICA_MAX_LAG_BYTES of the primary; otherwise to the primary.
+    """
+    if REPLICA_ENABLED:
+        try:
+            conn = connect_replica()
+        except psycopg2.OperationalError:
+            conn = None
+        if conn is not None:
+            try:
+                lag = replica_lag(conn)
+                if lag is not None and lag <= REPLICA_MAX_LAG_BYTES:
+                    return conn
+            except psycopg2.Error:
+                pass
+            conn.close()
+    return connect_primary()
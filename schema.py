@@ -0,0 +1,38 @@
+# schema.py
+
+import replica
+
+def ensure_session_schema():
+    """
+    Add the session-tracking column and indexes to support_activities.
+    Idempotent; run against the primary by the app and the analytics exporter.
+    """
+    conn = replica.connect_primary()
+    cur = conn.cursor()
+    cur.execute(
+        "ALTER TABLE support_activities ADD COLUMN IF NOT EXISTS last_heartbeat TIMESTAMPTZ"
+    )
+    # Only still-open rows need a heartbeat to be reaped; closed history is left alone.
+    cur.execute(
+        """
+        UPDATE support_activities
+        SET last_heartbeat = login_time
+        WHERE logout_time IS NULL AND last_heartbeat IS NULL
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_support_activities_open
+        ON support_activities (last_heartbeat)
+        WHERE logout_time IS NULL
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_support_activities_login_time
+        ON support_activities (login_time)
+        """
+    )
+    conn.commit()
+    cur.close()
+    conn.close()